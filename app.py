@@ -3,26 +3,63 @@ import os
 import csv
 from datetime import datetime
 import base64
-from io import BytesIO
+from io import BytesIO, StringIO
 import re
+import functools
+from collections import namedtuple
 from reportlab.lib.pagesizes import letter
 from reportlab.pdfgen import canvas
 from reportlab.lib.utils import ImageReader
 from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfbase.ttfonts import TTFont
-import arabic_reshaper
+from arabic_reshaper import ArabicReshaper
 from bidi.algorithm import get_display
 from PIL import Image
 import codecs
 import subprocess
 import platform
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 app = Flask(__name__)
 app.secret_key = 'programtrack_secret_key_2024'
+app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 3600
 
 PROGRAMS_DIR = os.path.join(os.path.dirname(__file__), 'programs')
 SYSTEM_CSV = os.path.join(PROGRAMS_DIR, 'system-programs.csv')
 
+# Program English names: letters, numbers, underscore, hyphen; \Z also rejects a trailing newline
+ENGLISH_NAME_RE = re.compile(r'^[a-zA-Z][a-zA-Z0-9_-]*\Z')
+
+# Accepted (lowercase) header names for imported users CSVs
+NATIONAL_ID_COLUMNS = frozenset({'nationalid', 'national id', 'رقم الهوية', 'رقم_الهوية'})
+FULL_NAME_COLUMNS = frozenset({'fullname', 'full name', 'الاسم', 'الاسم الكامل', 'الاسم_الكامل'})
+
+# Parsed system-programs.csv, reused until the file's mtime changes:
+# (mtime, programs, programs_by_name, visible_programs), replaced as a whole
+_programs_cache = None
+
+# One row of a <program>-users.csv file, in column order
+User = namedtuple('User', ['NationalID', 'FullName', 'HasReceived', 'DateReceived'])
+
+# Parsed <program>-users.csv files merged with their receipts.log:
+# program name -> ((csv mtime, log mtime), users, users_by_id, received_count)
+_users_cache = {}
+
+# Serializes users CSV appends and receipts.log writes against compaction
+_receipts_lock = threading.Lock()
+
+# Receipts are generated off the request thread
+_pdf_executor = ThreadPoolExecutor(max_workers=2)
+
+# File manager launcher, chosen once; Popen returns without waiting for it
+if platform.system() == 'Windows':
+    OPEN_FOLDER = os.startfile
+elif platform.system() == 'Darwin':  # macOS
+    OPEN_FOLDER = lambda path: subprocess.Popen(['open', path])
+else:  # Linux
+    OPEN_FOLDER = lambda path: subprocess.Popen(['xdg-open', path])
+
 # Register Arabic font (using a system font that supports Arabic)
 try:
     pdfmetrics.registerFont(TTFont('Arabic', 'C:/Windows/Fonts/arial.ttf'))
@@ -30,52 +67,93 @@ try:
 except:
     ARABIC_FONT = 'Helvetica'
 
+# Shared reshaper, configured once (defaults: drop harakat, use ligatures)
+ARABIC_RESHAPER = ArabicReshaper(configuration={'delete_harakat': True, 'support_ligatures': True})
+
+@functools.lru_cache(maxsize=1024)
 def arabic_text(text):
     """Reshape Arabic text for proper PDF rendering"""
     try:
-        reshaped = arabic_reshaper.reshape(text)
+        reshaped = ARABIC_RESHAPER.reshape(text)
         return get_display(reshaped)
     except:
         return text
 
+# Fixed receipt labels, reshaped once at import
+PDF_TITLE = arabic_text("إيصال استلام")
+PDF_ACKNOWLEDGMENT_LABEL = arabic_text("إقرار بالاستلام:")
+PDF_SIGNATURE_LABEL = arabic_text("التوقيع:")
+PDF_SIGNATURE_SAVED = arabic_text("[التوقيع محفوظ]")
+PDF_FOOTER = arabic_text("هذا إيصال رسمي")
+
 def ensure_system_csv():
     """Ensure system-programs.csv exists"""
     if not os.path.exists(PROGRAMS_DIR):
         os.makedirs(PROGRAMS_DIR)
     if not os.path.exists(SYSTEM_CSV):
         with open(SYSTEM_CSV, 'w', newline='', encoding='utf-8-sig') as f:
-            writer = csv.DictWriter(f, fieldnames=['EnglishName', 'ArabicName', 'ShowInList'])
-            writer.writeheader()
+            csv.writer(f).writerow(['EnglishName', 'ArabicName', 'ShowInList'])
 
-def get_all_programs():
-    """Get all programs from system-programs.csv"""
-    ensure_system_csv()
+# Checked once at startup; get_all_programs recreates the file if it disappears
+ensure_system_csv()
+
+def _load_programs():
+    """Parse system-programs.csv into the programs cache (reused until the file changes)"""
+    global _programs_cache
+    try:
+        mtime = os.stat(SYSTEM_CSV).st_mtime
+    except FileNotFoundError:
+        # Removed while the app was running
+        ensure_system_csv()
+        mtime = os.stat(SYSTEM_CSV).st_mtime
+    cached = _programs_cache
+    if cached and cached[0] == mtime:
+        return cached
+    
     programs = []
+    by_name = {}
     with open(SYSTEM_CSV, 'r', encoding='utf-8-sig') as f:
         reader = csv.DictReader(f)
         for row in reader:
             programs.append(row)
-    return programs
+            by_name.setdefault(row.get('EnglishName', '').strip(), row)
+    
+    visible = [p for p in programs if p.get('ShowInList', '').lower() == 'true']
+    
+    # Published in one assignment so other threads never see a half-built cache
+    _programs_cache = (mtime, programs, by_name, visible)
+    return _programs_cache
+
+def get_all_programs():
+    """Get all programs from system-programs.csv"""
+    return _load_programs()[1]
 
 def get_visible_programs():
     """Get only visible programs for main page"""
-    all_programs = get_all_programs()
-    return [p for p in all_programs if p.get('ShowInList', '').lower() == 'true']
+    return _load_programs()[3]
 
 def get_program_info(english_name):
     """Get program info by English name"""
-    programs = get_all_programs()
-    for p in programs:
-        if p.get('EnglishName', '').strip() == english_name.strip():
-            return p
-    return None
+    return _load_programs()[2].get(english_name.strip())
 
 def save_programs(programs):
     """Save all programs to system-programs.csv"""
-    with open(SYSTEM_CSV, 'w', newline='', encoding='utf-8-sig') as f:
-        writer = csv.DictWriter(f, fieldnames=['EnglishName', 'ArabicName', 'ShowInList'])
-        writer.writeheader()
-        writer.writerows(programs)
+    global _programs_cache
+    # Callers edit the cached list in place, so drop it even if the write fails
+    _programs_cache = None
+    rows = [(p.get('EnglishName', ''), p.get('ArabicName', ''), p.get('ShowInList', '')) for p in programs]
+    
+    # Write under a temporary name so readers never parse a partial file
+    tmp_path = SYSTEM_CSV + '.tmp'
+    try:
+        with open(tmp_path, 'w', newline='', encoding='utf-8-sig', buffering=1 << 20) as f:
+            writer = csv.writer(f)
+            writer.writerow(['EnglishName', 'ArabicName', 'ShowInList'])
+            writer.writerows(rows)
+        os.replace(tmp_path, SYSTEM_CSV)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
 
 def create_program_folder(english_name):
     """Create program folder and empty CSV"""
@@ -86,71 +164,248 @@ def create_program_folder(english_name):
     csv_path = os.path.join(program_dir, f"{english_name}-users.csv")
     if not os.path.exists(csv_path):
         with open(csv_path, 'w', newline='', encoding='utf-8-sig') as f:
-            writer = csv.DictWriter(f, fieldnames=['NationalID', 'FullName', 'HasReceived', 'DateReceived'])
-            writer.writeheader()
+            csv.writer(f).writerow(User._fields)
 
 def validate_english_name(name):
     """Validate English name (no spaces, only letters, numbers, underscore, hyphen)"""
-    pattern = r'^[a-zA-Z][a-zA-Z0-9_-]*$'
-    return bool(re.match(pattern, name))
+    return ENGLISH_NAME_RE.match(name) is not None
 
+@functools.lru_cache(maxsize=256)
 def get_csv_path(program_name):
     """Get the CSV file path for a program"""
     program_dir = os.path.join(PROGRAMS_DIR, program_name)
     csv_file = f"{program_name}-users.csv"
     return os.path.join(program_dir, csv_file)
 
-def read_users(program_name):
-    """Read all users from program CSV"""
+def get_receipts_log_path(program_name):
+    """Get the receipts log path for a program"""
+    return os.path.join(PROGRAMS_DIR, program_name, 'receipts.log')
+
+def read_header(reader):
+    """Get the first non-blank row of a CSV reader (files edited by hand may start with blank lines)"""
+    for row in reader:
+        if any(cell.strip() for cell in row):
+            return row
+    return []
+
+def user_column_indexes(header):
+    """Get the column index of each User field in a users CSV header (None if missing)"""
+    positions = {name.strip(): i for i, name in enumerate(header)}
+    return [positions.get(field) for field in User._fields]
+
+def read_receipts(program_name):
+    """Read receipts.log as {national_id: date_received}"""
+    receipts = {}
+    try:
+        with open(get_receipts_log_path(program_name), 'rb') as f:
+            for line in f:
+                national_id, _, date_received = line.decode('utf-8').rstrip('\r\n').partition('\t')
+                if national_id:
+                    receipts[national_id] = date_received
+    except FileNotFoundError:
+        pass
+    return receipts
+
+def _load_users(program_name):
+    """Read users, a NationalID index and the received count from program CSV (cached until the file changes)"""
     csv_path = get_csv_path(program_name)
+    try:
+        mtime = os.stat(csv_path).st_mtime
+    except OSError:
+        return [], {}, 0
+    try:
+        log_mtime = os.stat(get_receipts_log_path(program_name)).st_mtime
+    except OSError:
+        log_mtime = None
+    
+    cached = _users_cache.get(program_name)
+    if cached and cached[0] == (mtime, log_mtime):
+        return cached[1:]
+    
+    # Receipts not yet compacted into the CSV override its columns
+    receipts = read_receipts(program_name) if log_mtime is not None else {}
+    
     users = []
-    if os.path.exists(csv_path):
-        with open(csv_path, 'r', encoding='utf-8-sig') as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                users.append(row)
-    return users
+    users_by_id = {}
+    received = 0
+    with open(csv_path, 'r', encoding='utf-8-sig', buffering=1 << 20) as f:
+        reader = csv.reader(f)
+        columns = user_column_indexes(read_header(reader))
+        in_order = columns == [0, 1, 2, 3]
+        for row in reader:
+            if not row:
+                continue
+            if in_order and len(row) == 4:
+                user = User._make(row)
+            else:
+                user = User._make([row[i] if i is not None and i < len(row) else '' for i in columns])
+            if receipts and user.NationalID.strip() in receipts:
+                user = user._replace(HasReceived='true', DateReceived=receipts[user.NationalID.strip()])
+            users.append(user)
+            users_by_id.setdefault(user.NationalID.strip(), user)
+            if user.HasReceived.lower() == 'true':
+                received += 1
+    
+    _users_cache[program_name] = ((mtime, log_mtime), users, users_by_id, received)
+    return users, users_by_id, received
+
+def invalidate_users(program_name):
+    """Drop the cached users of a program before they are modified"""
+    _users_cache.pop(program_name, None)
+
+def read_users(program_name):
+    """Read all users from program CSV"""
+    return _load_users(program_name)[0]
 
 def find_user(program_name, national_id):
     """Find a user by national ID"""
-    users = read_users(program_name)
-    for user in users:
-        if user.get('NationalID', '').strip() == national_id.strip():
-            return user
-    return None
+    return _load_users(program_name)[1].get(national_id.strip())
 
 def update_user_received(program_name, national_id):
     """Update user's HasReceived status to true and set DateReceived"""
+    if find_user(program_name, national_id):
+        log_receipt(program_name, national_id.strip(), datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+
+def log_receipt(program_name, national_id, date_received):
+    """Append a receipt to the program's receipts.log instead of rewriting its CSV"""
+    with _receipts_lock:
+        invalidate_users(program_name)
+        with open(get_receipts_log_path(program_name), 'ab') as f:
+            f.write(f"{national_id}\t{date_received}\n".encode('utf-8'))
+
+def compact_receipts(program_name):
+    """Fold receipts.log into the program CSV, keeping only unmatched receipts in the log
+
+    Returns the number of receipts left in the log. Raises ValueError if the
+    CSV's header has no NationalID column.
+    """
     csv_path = get_csv_path(program_name)
-    users = read_users(program_name)
-    
-    for user in users:
-        if user.get('NationalID', '').strip() == national_id.strip():
-            user['HasReceived'] = 'true'
-            user['DateReceived'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            break
-    
-    with open(csv_path, 'w', newline='', encoding='utf-8-sig') as f:
-        fieldnames = ['NationalID', 'FullName', 'HasReceived', 'DateReceived']
-        writer = csv.DictWriter(f, fieldnames=fieldnames)
-        writer.writeheader()
-        writer.writerows(users)
+    log_path = get_receipts_log_path(program_name)
+    with _receipts_lock:
+        if not os.path.exists(log_path) or not os.path.exists(csv_path):
+            return 0
+        receipts = read_receipts(program_name)
+        
+        # Keep the file's own header and cells; only the receipt columns change
+        with open(csv_path, 'r', newline='', encoding='utf-8-sig') as f:
+            reader = csv.reader(f)
+            header = read_header(reader) or list(User._fields)
+            rows = list(reader)
+        for field in ('HasReceived', 'DateReceived'):
+            if field not in [name.strip() for name in header]:
+                header.append(field)
+        id_index, _, received_index, date_index = user_column_indexes(header)
+        if id_index is None:
+            raise ValueError("ملف CSV للبرنامج لا يحتوي على عمود NationalID")
+        
+        applied = set()
+        row_width = max(received_index, date_index) + 1
+        for row in rows:
+            national_id = row[id_index].strip() if id_index < len(row) else ''
+            if national_id in receipts:
+                row += [''] * (row_width - len(row))
+                row[received_index] = 'true'
+                row[date_index] = receipts[national_id]
+                applied.add(national_id)
+        
+        if applied:
+            # Write the merged users under a temporary name, then swap it in
+            invalidate_users(program_name)
+            tmp_path = csv_path + '.tmp'
+            try:
+                with open(tmp_path, 'w', newline='', encoding='utf-8-sig', buffering=1 << 20) as f:
+                    writer = csv.writer(f)
+                    writer.writerow(header)
+                    writer.writerows(rows)
+                os.replace(tmp_path, csv_path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+        
+        # Receipts without a matching row are only recorded in the log, so keep them
+        leftover = [(national_id, date_received) for national_id, date_received in receipts.items()
+                    if national_id not in applied]
+        if not leftover:
+            os.remove(log_path)
+        elif applied:
+            invalidate_users(program_name)
+            tmp_path = log_path + '.tmp'
+            try:
+                with open(tmp_path, 'wb') as f:
+                    for national_id, date_received in leftover:
+                        f.write(f"{national_id}\t{date_received}\n".encode('utf-8'))
+                os.replace(tmp_path, log_path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+        return len(leftover)
+
+def _place_cells(row, placed, width):
+    """Lay a User-ordered row out in a CSV's own column order"""
+    cells = [''] * width
+    for i, j in placed:
+        cells[i] = row[j]
+    return cells
+
+def append_users(program_name, rows):
+    """Append (NationalID, FullName, HasReceived, DateReceived) rows to program CSV
+
+    Raises ValueError if the CSV's header has no NationalID or FullName column.
+    """
+    csv_path = get_csv_path(program_name)
+    with _receipts_lock:
+        needs_header = not os.path.exists(csv_path) or os.path.getsize(csv_path) == 0
+        needs_newline = False
+        if not needs_header:
+            # Files edited by hand may not end with a newline
+            with open(csv_path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                needs_newline = f.read(1) not in (b'\n', b'\r')
+            
+            # ... or have their columns reordered or extended; follow their header
+            with open(csv_path, 'r', newline='', encoding='utf-8-sig') as f:
+                header = read_header(csv.reader(f))
+            if not header:
+                # Only a BOM or blank lines are left, start over with the standard header
+                needs_header = True
+            else:
+                columns = user_column_indexes(header)
+                if columns[0] is None or columns[1] is None:
+                    raise ValueError("ملف CSV للبرنامج لا يحتوي على عمودي NationalID و FullName")
+                if columns != [0, 1, 2, 3] or len(header) != 4:
+                    placed = [(i, j) for j, i in enumerate(columns) if i is not None]
+                    rows = [_place_cells(row, placed, len(header)) for row in rows]
+        
+        invalidate_users(program_name)
+        with open(csv_path, 'a', newline='', encoding='utf-8-sig', buffering=1 << 20) as f:
+            if needs_newline:
+                f.write('\r\n')
+            writer = csv.writer(f)
+            if needs_header:
+                writer.writerow(User._fields)
+            writer.writerows(rows)
 
 def generate_pdf(program_name, national_id, full_name, signature_data):
     """Generate PDF receipt with acknowledgment and signature"""
     program_dir = os.path.join(PROGRAMS_DIR, program_name)
     pdf_path = os.path.join(program_dir, f"{national_id}.pdf")
+    # Written under a temporary name so get_program_pdfs never lists a partial file
+    tmp_path = pdf_path + '.tmp'
     
     # Get Arabic name for display
     program_info = get_program_info(program_name)
     arabic_program_name = program_info.get('ArabicName', program_name) if program_info else program_name
     
-    c = canvas.Canvas(pdf_path, pagesize=letter)
+    now = datetime.now()
+    date_str = now.strftime('%Y-%m-%d')
+    time_str = now.strftime('%H:%M:%S')
+    
+    # Each font size is set once; the title size is the canvas's initial font
+    c = canvas.Canvas(tmp_path, pagesize=letter, initialFontName=ARABIC_FONT, initialFontSize=24)
     width, height = letter
     
     # Title
-    c.setFont(ARABIC_FONT, 24)
-    c.drawCentredString(width/2, height - 80, arabic_text("إيصال استلام"))
+    c.drawCentredString(width/2, height - 80, PDF_TITLE)
     
     # Program name
     c.setFont(ARABIC_FONT, 16)
@@ -163,20 +418,19 @@ def generate_pdf(program_name, national_id, full_name, signature_data):
     c.setFont(ARABIC_FONT, 14)
     c.drawRightString(width - 50, height - 180, arabic_text(f"رقم الهوية: {national_id}"))
     c.drawRightString(width - 50, height - 210, arabic_text(f"الاسم الكامل: {full_name}"))
-    c.drawRightString(width - 50, height - 240, arabic_text(f"تاريخ الاستلام: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"))
+    c.drawRightString(width - 50, height - 240, arabic_text(f"تاريخ الاستلام: {date_str} {time_str}"))
     
-    # Acknowledgment text
+    # Acknowledgment and signature labels
     c.setFont(ARABIC_FONT, 12)
-    c.drawRightString(width - 50, height - 290, arabic_text("إقرار بالاستلام:"))
+    c.drawRightString(width - 50, height - 290, PDF_ACKNOWLEDGMENT_LABEL)
+    c.drawRightString(width - 50, height - 390, PDF_SIGNATURE_LABEL)
+    
+    # Acknowledgment text
     c.setFont(ARABIC_FONT, 11)
     acknowledgment_text = f"أقر أنا، {full_name}، بأنني قد استلمت المواد/الأغراض"
     c.drawRightString(width - 50, height - 315, arabic_text(acknowledgment_text))
     c.drawRightString(width - 50, height - 335, arabic_text(f"من {arabic_program_name}."))
     
-    # Signature
-    c.setFont(ARABIC_FONT, 12)
-    c.drawRightString(width - 50, height - 390, arabic_text("التوقيع:"))
-    
     # Add signature image with white background
     if signature_data and signature_data.startswith('data:image'):
         try:
@@ -184,53 +438,64 @@ def generate_pdf(program_name, national_id, full_name, signature_data):
             img_bytes = base64.b64decode(img_data)
             
             img = Image.open(BytesIO(img_bytes))
-            if img.mode in ('RGBA', 'LA', 'P'):
-                background = Image.new('RGB', img.size, (255, 255, 255))
-                if img.mode == 'P':
-                    img = img.convert('RGBA')
-                background.paste(img, mask=img.split()[-1] if img.mode == 'RGBA' else None)
-                img = background
-            
-            img_buffer = BytesIO()
-            img.save(img_buffer, format='PNG')
-            img_buffer.seek(0)
+            if img.mode in ('RGB', 'L'):
+                # Already opaque, hand the original bytes to ReportLab
+                img_reader = ImageReader(BytesIO(img_bytes))
+            else:
+                # Flatten transparency onto white; ReportLab takes the PIL image directly
+                background = Image.new('RGBA', img.size, (255, 255, 255, 255))
+                img = Image.alpha_composite(background, img.convert('RGBA')).convert('RGB')
+                img_reader = ImageReader(img)
             
-            img_reader = ImageReader(img_buffer)
             c.drawImage(img_reader, width - 300, height - 550, width=250, height=120, preserveAspectRatio=True)
         except Exception as e:
-            c.drawRightString(width - 50, height - 420, arabic_text("[التوقيع محفوظ]"))
+            c.setFont(ARABIC_FONT, 12)
+            c.drawRightString(width - 50, height - 420, PDF_SIGNATURE_SAVED)
     
     # Footer
     c.line(50, 80, width - 50, 80)
     c.setFont(ARABIC_FONT, 10)
-    c.drawCentredString(width/2, 60, arabic_text("هذا إيصال رسمي"))
-    c.drawCentredString(width/2, 45, arabic_text(f"تم الإنشاء بتاريخ {datetime.now().strftime('%Y-%m-%d')} الساعة {datetime.now().strftime('%H:%M:%S')}"))
+    c.drawCentredString(width/2, 60, PDF_FOOTER)
+    c.drawCentredString(width/2, 45, arabic_text(f"تم الإنشاء بتاريخ {date_str} الساعة {time_str}"))
     
-    c.save()
+    try:
+        c.save()
+        os.replace(tmp_path, pdf_path)
+    finally:
+        # Don't leave a partial receipt behind if saving failed
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
     return pdf_path
 
+def log_pdf_error(future):
+    """Log a receipt that failed to generate in the background"""
+    error = future.exception()
+    if error:
+        app.logger.error('Failed to generate PDF receipt', exc_info=error)
+
 def get_program_pdfs(english_name):
     """Get list of all PDFs for a program"""
     program_dir = os.path.join(PROGRAMS_DIR, english_name)
     pdfs = []
     if os.path.exists(program_dir):
-        for file in os.listdir(program_dir):
-            if file.endswith('.pdf'):
-                national_id = file.replace('.pdf', '')
-                # Try to find user name
-                user = find_user(english_name, national_id)
-                user_name = user.get('FullName', 'غير معروف') if user else 'غير معروف'
-                
-                # Get file modification time
-                file_path = os.path.join(program_dir, file)
-                mod_time = datetime.fromtimestamp(os.path.getmtime(file_path))
-                
-                pdfs.append({
-                    'filename': file,
-                    'national_id': national_id,
-                    'user_name': user_name,
-                    'date': mod_time.strftime('%Y-%m-%d %H:%M:%S')
-                })
+        users_by_id = _load_users(english_name)[1]
+        with os.scandir(program_dir) as entries:
+            for entry in entries:
+                if entry.name.endswith('.pdf'):
+                    national_id = entry.name[:-len('.pdf')]
+                    # Try to find user name
+                    user = users_by_id.get(national_id.strip())
+                    user_name = user.FullName if user else 'غير معروف'
+                    
+                    # Get file modification time
+                    mod_time = datetime.fromtimestamp(entry.stat().st_mtime)
+                    
+                    pdfs.append({
+                        'filename': entry.name,
+                        'national_id': national_id,
+                        'user_name': user_name,
+                        'date': mod_time.strftime('%Y-%m-%d %H:%M:%S')
+                    })
     
     # Sort by date (newest first)
     pdfs.sort(key=lambda x: x['date'], reverse=True)
@@ -238,37 +503,23 @@ def get_program_pdfs(english_name):
 
 def add_user_to_program(program_name, national_id, full_name):
     """Add a new user to program CSV"""
-    csv_path = get_csv_path(program_name)
-    users = read_users(program_name)
-    
     # Check if user already exists
-    for user in users:
-        if user.get('NationalID', '').strip() == national_id.strip():
-            return False, "رقم الهوية موجود مسبقاً"
+    if find_user(program_name, national_id):
+        return False, "رقم الهوية موجود مسبقاً"
     
     # Add new user
-    users.append({
-        'NationalID': national_id,
-        'FullName': full_name,
-        'HasReceived': 'false',
-        'DateReceived': ''
-    })
-    
-    with open(csv_path, 'w', newline='', encoding='utf-8-sig') as f:
-        fieldnames = ['NationalID', 'FullName', 'HasReceived', 'DateReceived']
-        writer = csv.DictWriter(f, fieldnames=fieldnames)
-        writer.writeheader()
-        writer.writerows(users)
+    try:
+        append_users(program_name, [(national_id, full_name, 'false', '')])
+    except ValueError as e:
+        return False, str(e)
     
     return True, "تم إضافة المستخدم بنجاح"
 
 def import_users_from_csv(program_name, file_content):
     """Import users from uploaded CSV file"""
-    csv_path = get_csv_path(program_name)
-    existing_users = read_users(program_name)
-    existing_ids = {user.get('NationalID', '').strip() for user in existing_users}
+    existing_ids = set(_load_users(program_name)[1])
     
-    imported_count = 0
+    new_users = []
     skipped_count = 0
     
     try:
@@ -281,50 +532,43 @@ def import_users_from_csv(program_name, file_content):
             except:
                 content = file_content.decode('latin-1')
         
-        lines = content.strip().split('\n')
-        
         # Parse CSV
-        reader = csv.DictReader(lines)
+        reader = csv.reader(StringIO(content.strip()))
+        header = [name.strip().lower() for name in next(reader, [])]
+        
+        # Find the columns once by their possible names
+        id_index = next((i for i, name in enumerate(header) if name in NATIONAL_ID_COLUMNS), None)
+        name_index = next((i for i, name in enumerate(header) if name in FULL_NAME_COLUMNS), None)
+        if id_index is None or name_index is None:
+            return False, "خطأ في استيراد الملف: يجب أن يحتوي الملف على عمودي NationalID و FullName"
         
+        row_width = max(id_index, name_index) + 1
         for row in reader:
-            # Try different possible column names
-            national_id = row.get('NationalID') or row.get('nationalid') or row.get('National ID') or row.get('رقم الهوية') or row.get('رقم_الهوية') or ''
-            full_name = row.get('FullName') or row.get('fullname') or row.get('Full Name') or row.get('الاسم') or row.get('الاسم الكامل') or row.get('الاسم_الكامل') or ''
-            
-            national_id = str(national_id).strip()
-            full_name = str(full_name).strip()
+            if len(row) < row_width:
+                continue
+            national_id = row[id_index].strip()
+            full_name = row[name_index].strip()
             
             if national_id and full_name:
                 if national_id not in existing_ids:
-                    existing_users.append({
-                        'NationalID': national_id,
-                        'FullName': full_name,
-                        'HasReceived': 'false',
-                        'DateReceived': ''
-                    })
+                    new_users.append((national_id, full_name, 'false', ''))
                     existing_ids.add(national_id)
-                    imported_count += 1
                 else:
                     skipped_count += 1
         
-        # Save updated users
-        with open(csv_path, 'w', newline='', encoding='utf-8-sig') as f:
-            fieldnames = ['NationalID', 'FullName', 'HasReceived', 'DateReceived']
-            writer = csv.DictWriter(f, fieldnames=fieldnames)
-            writer.writeheader()
-            writer.writerows(existing_users)
+        # Save new users
+        if new_users:
+            append_users(program_name, new_users)
         
-        return True, f"تم استيراد {imported_count} مستخدم. تم تخطي {skipped_count} (موجودين مسبقاً)"
+        return True, f"تم استيراد {len(new_users)} مستخدم. تم تخطي {skipped_count} (موجودين مسبقاً)"
     
     except Exception as e:
         return False, f"خطأ في استيراد الملف: {str(e)}"
 
 def get_program_users_count(program_name):
     """Get count of users and received count for a program"""
-    users = read_users(program_name)
-    total = len(users)
-    received = sum(1 for u in users if u.get('HasReceived', '').lower() == 'true')
-    return total, received
+    users, _, received = _load_users(program_name)
+    return len(users), received
 
 @app.context_processor
 def inject_now():
@@ -470,19 +714,39 @@ def open_csv_folder(english_name):
     csv_path = get_csv_path(english_name)
     folder_path = os.path.dirname(csv_path)
     
+    # Bring the CSV up to date before it is edited by hand; it may be open in Excel
+    try:
+        compact_receipts(english_name)
+    except Exception as e:
+        flash(f'لم يتم دمج سجل الاستلام في ملف CSV: {str(e)}', 'error')
+    
     try:
-        if platform.system() == 'Windows':
-            os.startfile(folder_path)
-        elif platform.system() == 'Darwin':  # macOS
-            subprocess.run(['open', folder_path])
-        else:  # Linux
-            subprocess.run(['xdg-open', folder_path])
+        OPEN_FOLDER(folder_path)
         flash('تم فتح مجلد البرنامج', 'success')
     except Exception as e:
         flash(f'لا يمكن فتح المجلد: {str(e)}', 'error')
     
     return redirect(url_for('edit_program', english_name=english_name))
 
+@app.route('/manage/compact/<english_name>')
+def compact_program(english_name):
+    """Fold logged receipts into the program's users CSV"""
+    program = get_program_info(english_name)
+    if not program:
+        flash('البرنامج غير موجود', 'error')
+        return redirect(url_for('manage_programs'))
+    
+    try:
+        leftover = compact_receipts(english_name)
+        if leftover:
+            flash(f'تم دمج سجل الاستلام في ملف CSV، وبقي {leftover} استلام بدون مستخدم مطابق في receipts.log', 'error')
+        else:
+            flash('تم دمج سجل الاستلام في ملف CSV', 'success')
+    except Exception as e:
+        flash(f'لا يمكن دمج سجل الاستلام: {str(e)}', 'error')
+    
+    return redirect(url_for('edit_program', english_name=english_name))
+
 @app.route('/verify/<program_name>', methods=['GET', 'POST'])
 def verify(program_name):
     """User verification page"""
@@ -504,8 +768,8 @@ def verify(program_name):
             message = f"المستخدم غير موجود. الرجاء إضافة رقم الهوية يدوياً في ملف {program_name}-users.csv"
             return render_template('message.html', message=message, message_type='error', program_name=program_name, program_info=program_info)
         
-        if user.get('HasReceived', '').lower() == 'true':
-            message = f"المستخدم {user.get('FullName', 'غير معروف')} قد استلم المواد مسبقاً بتاريخ {user.get('DateReceived', 'غير محدد')}."
+        if user.HasReceived.lower() == 'true':
+            message = f"المستخدم {user.FullName} قد استلم المواد مسبقاً بتاريخ {user.DateReceived}."
             return render_template('message.html', message=message, message_type='warning', program_name=program_name, program_info=program_info)
         
         return redirect(url_for('acknowledgment', program_name=program_name, national_id=national_id))
@@ -530,9 +794,10 @@ def acknowledgment(program_name, national_id):
             return render_template('acknowledgment.html', user=user, program_name=program_name, program_info=program_info)
         
         update_user_received(program_name, national_id)
-        generate_pdf(program_name, national_id, user.get('FullName', ''), signature_data)
+        future = _pdf_executor.submit(generate_pdf, program_name, national_id, user.FullName, signature_data)
+        future.add_done_callback(log_pdf_error)
         
-        message = f"شكراً لك، {user.get('FullName')}! تم تسجيل الاستلام وإنشاء الإيصال بنجاح."
+        message = f"شكراً لك، {user.FullName}! تم تسجيل الاستلام بنجاح، وجارٍ إنشاء الإيصال."
         return render_template('message.html', message=message, message_type='success', program_name=program_name, program_info=program_info)
     
     return render_template('acknowledgment.html', user=user, program_name=program_name, program_info=program_info)
@@ -566,14 +831,20 @@ def download_pdf(english_name, filename):
         flash('الملف غير موجود', 'error')
         return redirect(url_for('view_pdfs', english_name=english_name))
     
-    # Send file with correct mimetype and inline disposition to view in browser
-    return send_file(
+    # Send file with correct mimetype and inline disposition to view in browser;
+    # conditional requests get 304 Not Modified from its ETag / Last-Modified
+    response = send_file(
         file_path, 
         mimetype='application/pdf',
         as_attachment=False,
-        download_name=filename
+        download_name=filename,
+        conditional=True,
+        max_age=3600
     )
+    # Receipts hold national IDs and signatures; only the browser may cache them
+    response.cache_control.public = False
+    response.cache_control.private = True
+    return response
 
 if __name__ == '__main__':
-    ensure_system_csv()
     app.run(host='0.0.0.0', port=5000, debug=True)